@@ -0,0 +1,53 @@
+"""
+This module measures the tiled generation of the height map with different numbers of worker processes.
+It checks that every result is bit-identical to the single process one and reports the speedup and the memory used.
+"""
+
+import argparse
+import os
+import time
+import tracemalloc
+import numpy as np
+
+import terrain_core
+
+# Generates and fades one height map, returning it with the time taken and the peak of the parent's heap
+# NumPy reports its arrays to tracemalloc, so a copy of the map in the parent shows up in the peak
+def measure_generation(size, noise_scale, fade_margin, water_level, seed, workers):
+    tracemalloc.start()
+    generation_start = time.perf_counter()
+    heightmap = terrain_core.generate_heightmap(size, noise_scale, seed=seed, workers=workers)
+    heightmap = terrain_core.apply_edge_fade(heightmap, fade_margin, water_level, workers=workers)
+    generation_time = time.perf_counter() - generation_start
+    heap_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return heightmap, generation_time, heap_peak
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the tiled height map generation")
+    parser.add_argument("--size", type=int, default=1024, help="Dimension of the height map")
+    parser.add_argument("--noise-scale", type=float, default=10, help="Frequency of the Perlin noise")
+    parser.add_argument("--fade-margin", type=int, default=7, help="Number of cells faded on the edges")
+    parser.add_argument("--seed", type=int, default=1234, help="Seed of the height map")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, os.cpu_count() or 1],
+                        help="Numbers of worker processes to measure")
+    args = parser.parse_args()
+
+    worker_counts = sorted(set(args.workers) | {1})
+    map_size = args.size * args.size * 8 / 2**20
+    print(f"Height map {args.size} x {args.size} ({map_size:.1f} MB), seed {args.seed}")
+    print(f"{'workers':>8} {'time (s)':>10} {'speedup':>8} {'parent heap (MB)':>17} {'identical':>10}")
+
+    reference = None
+    reference_time = None
+    for workers in worker_counts:
+        heightmap, generation_time, heap_peak = measure_generation(
+            args.size, args.noise_scale, args.fade_margin, 0, args.seed, workers)
+        if reference is None:
+            reference, reference_time = np.array(heightmap), generation_time
+        identical = np.array_equal(reference, heightmap)
+        print(f"{workers:>8} {generation_time:>10.2f} {reference_time / generation_time:>8.2f} "
+              f"{heap_peak / 2**20:>17.1f} {str(identical):>10}")
+
+if __name__ == "__main__":
+    main()
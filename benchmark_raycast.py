@@ -0,0 +1,86 @@
+"""
+This module measures the batched ray casting of terrain_raycast on a generated world.
+It reports the time of batches of vertical rays (ground snapping, tree placement) and of oblique rays
+(line of sight, mouse picking), and how many rays of each kind fit in a per-frame time budget.
+"""
+
+import argparse
+import time
+import numpy as np
+
+import terrain_core
+import terrain_raycast
+
+# Builds the height pyramid of a generated and faded height map, like main.build_world
+def build_pyramid(size, noise_scale, fade_margin, terrain_scale, seed):
+    heightmap = terrain_core.generate_heightmap(size, noise_scale, seed=seed)
+    heightmap = terrain_core.apply_edge_fade(heightmap, fade_margin, 0)
+    heights = terrain_core.heightmap_world_heights(heightmap, terrain_scale)
+    return terrain_raycast.build_height_pyramid(heights, cell_size=terrain_scale)
+
+# Random rays over the terrain, straight down from above it or in random downward directions from near it
+def random_rays(pyramid, ray_count, vertical, generator):
+    extent = pyramid["level_shapes"][0] * pyramid["cell_size"]
+    top = pyramid["node_max"][-1]
+    if vertical:
+        origins = np.column_stack([generator.uniform(0, extent[0], ray_count), np.full(ray_count, top + 10),
+                                   generator.uniform(0, extent[1], ray_count)])
+        directions = np.tile([0.0, -1.0, 0.0], (ray_count, 1))
+    else:
+        origins = np.column_stack([generator.uniform(0, extent[0], ray_count), generator.uniform(0, top + 10, ray_count),
+                                   generator.uniform(0, extent[1], ray_count)])
+        directions = generator.normal(size=(ray_count, 3))
+        directions[:, 1] = -np.abs(directions[:, 1])
+    return origins, directions
+
+# Best time of several casts of the same batch, the first one also warms up the caches
+def measure_cast(pyramid, origins, directions, repeat):
+    best_time = np.inf
+    for _ in range(repeat):
+        cast_start = time.perf_counter()
+        terrain_raycast.cast_rays(pyramid, origins, directions)
+        best_time = min(best_time, time.perf_counter() - cast_start)
+    return best_time
+
+# Largest batch, doubling from 64 rays, that is cast within the budget
+def rays_within_budget(pyramid, vertical, budget, repeat, generator):
+    ray_count = 64
+    supported = 0
+    while ray_count <= 2**20:
+        origins, directions = random_rays(pyramid, ray_count, vertical, generator)
+        if measure_cast(pyramid, origins, directions, repeat) > budget:
+            break
+        supported = ray_count
+        ray_count *= 2
+    return supported
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the batched terrain ray casting")
+    parser.add_argument("--size", type=int, default=100, help="Dimension of the height map")
+    parser.add_argument("--noise-scale", type=float, default=10, help="Frequency of the Perlin noise")
+    parser.add_argument("--fade-margin", type=int, default=7, help="Number of cells faded on the edges")
+    parser.add_argument("--terrain-scale", type=float, default=5, help="Scaling of the world")
+    parser.add_argument("--seed", type=int, default=1234, help="Seed of the height map")
+    parser.add_argument("--rays", type=int, nargs="+", default=[250, 1000, 4000], help="Batch sizes to measure")
+    parser.add_argument("--budget-ms", type=float, default=2.0, help="Time per frame given to ray casting")
+    parser.add_argument("--repeat", type=int, default=5, help="Casts of every batch, the best one is reported")
+    args = parser.parse_args()
+
+    generator = np.random.default_rng(args.seed)
+    pyramid = build_pyramid(args.size, args.noise_scale, args.fade_margin, args.terrain_scale, args.seed)
+    print(f"Height map {args.size} x {args.size}, {len(pyramid['level_shapes'])} pyramid levels, seed {args.seed}")
+    print(f"{'rays':>8} {'vertical (ms)':>14} {'oblique (ms)':>13}")
+    for ray_count in args.rays:
+        times = []
+        for vertical in (True, False):
+            origins, directions = random_rays(pyramid, ray_count, vertical, generator)
+            times.append(measure_cast(pyramid, origins, directions, args.repeat) * 1000)
+        print(f"{ray_count:>8} {times[0]:>14.2f} {times[1]:>13.2f}")
+
+    budget = args.budget_ms / 1000
+    print(f"Rays per frame within {args.budget_ms:g} ms (largest power of two batch): "
+          f"vertical {rays_within_budget(pyramid, True, budget, args.repeat, generator)}, "
+          f"oblique {rays_within_budget(pyramid, False, budget, args.repeat, generator)}")
+
+if __name__ == "__main__":
+    main()
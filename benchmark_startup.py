@@ -0,0 +1,59 @@
+"""
+This module measures how long it takes to import each of the program modules in a fresh interpreter.
+It also reports whether the import loaded the engine (Ursina) or the audio library (pygame),
+so the modules meant to stay engine-free can be checked.
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+# Modules measured, from the engine-free ones to the entry point
+startup_modules = ["terrain_core", "terrain_raycast", "procedural_terrain", "main"]
+
+# Code run by every fresh interpreter, it prints the import time and the heavy libraries loaded as JSON
+probe_code = """
+import json, sys, time
+start = time.perf_counter()
+if {module!r}:
+    __import__({module!r})
+import_time = time.perf_counter() - start
+print(json.dumps({{"time": import_time, "ursina": "ursina" in sys.modules, "pygame": "pygame" in sys.modules}}))
+"""
+
+# Imports one module in a new interpreter and returns the result of the probe, the interpreter start is included
+def measure_import(module):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", probe_code.format(module=module)],
+                            capture_output=True, text=True)
+    total_time = time.perf_counter() - start
+    if result.returncode != 0:
+        return {"error": result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "failed"}
+    measure = json.loads(result.stdout.strip().splitlines()[-1])
+    measure["total"] = total_time
+    return measure
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the import time of the program modules")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of fresh interpreters for each module")
+    parser.add_argument("modules", nargs="*", default=startup_modules, help="Modules to measure")
+    args = parser.parse_args()
+
+    print(f"{'module':>20} {'import (s)':>11} {'process (s)':>12} {'ursina':>7} {'pygame':>7}")
+    for module in [""] + args.modules:
+        measures = [measure_import(module) for _ in range(args.repeat)]
+        name = module or "(interpreter)"
+        errors = [measure["error"] for measure in measures if "error" in measure]
+        if errors:
+            print(f"{name:>20} {errors[0]}")
+            continue
+        # The best run is reported, the others are slowed down by the disk cache and the bytecode compilation
+        import_time = min(measure["time"] for measure in measures)
+        total_time = min(measure["total"] for measure in measures)
+        print(f"{name:>20} {import_time:>11.3f} {total_time:>12.3f} "
+              f"{str(measures[0]['ursina']):>7} {str(measures[0]['pygame']):>7}")
+
+if __name__ == "__main__":
+    main()
@@ -3,102 +3,156 @@ This module manages the different Shaders needed for terrain textures.
 """
 
 from ursina import *
+from PIL import Image
 
 # Shader to blend 3 textures based on terrain height
 """
 Shader Explanation:
-smoothstep: A smoothing function that takes three parameters: the two edges of the transition (edge0 and edge1) and the variable to interpolate (x). It returns a value smoothly interpolated between 0 and 1.
+The blend weights only depend on the static height, so they are baked once on the CPU (terrain_core.bake_terrain_maps)
+and read from a small splat texture instead of being evaluated with smoothstep for every fragment.
 texture1: Texture for low heights.
 texture2: Texture for mid heights.
 texture3: Texture for high heights.
-blend1: Interpolation between textures 1 and 2 based on height between 0 and 2 units.
-blend2: Interpolation between textures 2 and 3 based on height between 2 and 4 units.
+splat_map: Red channel blends textures 1 and 2, green channel blends the result with texture 3.
+color_map: Low resolution colour map with the three textures already composited, faded in between 80% and 100% of far_distance.
+Only the textures with a weight above 0 are sampled, with gradients taken before the branches so mipmapping stays correct.
 """
-def apply_terrain_shader(terrain_entity, planet_assets):
-    terrain_shader = Shader(
-        name='triplanar_shader', language=Shader.GLSL,
-        vertex='''
-        #version 140
-        uniform mat4 p3d_ModelViewProjectionMatrix;
-        uniform mat4 p3d_ModelMatrix;
-        in vec2 p3d_MultiTexCoord0;
-        in vec4 p3d_Vertex;
-        in vec3 p3d_Normal;
-        in vec4 p3d_Color;
-        out vec3 world_normal;
-        out vec3 vertex_world_position;
-        out vec2 texcoord;
-        out vec4 vertex_color;
+terrain_shader = Shader(
+    name='triplanar_shader', language=Shader.GLSL,
+    vertex='''
+    #version 140
+    uniform mat4 p3d_ModelViewProjectionMatrix;
+    uniform mat4 p3d_ModelMatrix;
+    uniform float grid_size;
+    in vec2 p3d_MultiTexCoord0;
+    in vec4 p3d_Vertex;
+    in vec3 p3d_Normal;
+    in vec4 p3d_Color;
+    out vec3 world_normal;
+    out vec3 vertex_world_position;
+    out vec2 texcoord;
+    out vec2 splat_coord;
+    out float view_depth;
+    out vec4 vertex_color;
 
-        void main() {
-          gl_Position = p3d_ModelViewProjectionMatrix * p3d_Vertex;
-          texcoord = p3d_MultiTexCoord0;
+    void main() {
+      gl_Position = p3d_ModelViewProjectionMatrix * p3d_Vertex;
+      texcoord = p3d_MultiTexCoord0;
+      // The vertices of the grid are at integer X and Z, so each one lands on the centre of its texel
+      splat_coord = (p3d_Vertex.xz + 0.5) / grid_size;
+      view_depth = gl_Position.w;
 
-          world_normal = normalize(mat3(p3d_ModelMatrix) * p3d_Normal);
-          vertex_world_position = (p3d_ModelMatrix * p3d_Vertex).xyz;
-          vertex_color = p3d_Color;
-        }
-        ''',
-
-        fragment='''
-        #version 140
-
-        uniform vec4 p3d_ColorScale;
-        in vec2 texcoord;
-        out vec4 fragColor;
+      world_normal = normalize(mat3(p3d_ModelMatrix) * p3d_Normal);
+      vertex_world_position = (p3d_ModelMatrix * p3d_Vertex).xyz;
+      vertex_color = p3d_Color;
+    }
+    ''',
 
-        uniform sampler2D texture1;
-        uniform sampler2D texture2;
-        uniform sampler2D texture3;
-        in vec3 world_normal;
-        in vec3 vertex_world_position;
+    fragment='''
+    #version 140
 
-        uniform vec2 texture_scale;
-        uniform vec2 side_texture_scale;
+    uniform vec4 p3d_ColorScale;
+    in vec2 texcoord;
+    in vec2 splat_coord;
+    in float view_depth;
+    out vec4 fragColor;
 
-        in vec4 vertex_color;
+    uniform sampler2D texture1;
+    uniform sampler2D texture2;
+    uniform sampler2D texture3;
+    uniform sampler2D splat_map;
+    uniform sampler2D color_map;
+    uniform float far_distance;
+    in vec3 world_normal;
+    in vec3 vertex_world_position;
 
-        // Function to calculate smooth transitions between textures
-        float smoothstep(float edge0, float edge1, float x) {
-            x = clamp((x - edge0) / (edge1 - edge0), 0.0, 1.0);
-            return x * x * (3.0 - 2.0 * x);
-        }
+    uniform vec2 texture_scale;
+    uniform vec2 side_texture_scale;
 
-        void main() {
-            // Get the vertex height in the world
-            float height = vertex_world_position.y;
+    in vec4 vertex_color;
 
-            // Read the textures
-            vec4 color1 = texture(texture1, texcoord);
-            vec4 color2 = texture(texture2, texcoord);
-            vec4 color3 = texture(texture3, texcoord);
+    void main() {
+        // Gradients are taken before any branch, derivatives inside non-uniform control flow are undefined
+        // Every map is then read with textureGrad, so each fragment only samples the maps it uses
+        vec2 dx = dFdx(texcoord);
+        vec2 dy = dFdy(texcoord);
+        vec2 splat_dx = dFdx(splat_coord);
+        vec2 splat_dy = dFdy(splat_coord);
 
-            // DEBUG Modify the transition heights
-            float blend1 = smoothstep(1.0, 2.5, height);
-            float blend2 = smoothstep(13.0, 18.0, height);
+        // Distant terrain fades into the pre-composited colour map over a band instead of a hard cut
+        float far_blend = smoothstep(far_distance * 0.8, far_distance, view_depth);
+        vec4 far_color = vec4(0.0);
+        if (far_blend > 0.0) {
+            far_color = textureGrad(color_map, splat_coord, splat_dx, splat_dy);
+        }
+        if (far_blend >= 1.0) {
+            fragColor = far_color * vertex_color;
+            return;
+        }
 
-            // Mix the textures based on heights
-            vec4 mixed_color = mix(color1, color2, blend1);
-            mixed_color = mix(mixed_color, color3, blend2);
+        // Baked blend weights of the three textures
+        vec2 blend = textureGrad(splat_map, splat_coord, splat_dx, splat_dy).rg;
+        vec3 weights = vec3((1.0 - blend.x) * (1.0 - blend.y), blend.x * (1.0 - blend.y), blend.y);
 
-            fragColor = mixed_color * vertex_color;
+        // Mix the textures, skipping the ones that do not contribute
+        vec4 mixed_color = vec4(0.0);
+        if (weights.x > 0.0) {
+            mixed_color += weights.x * textureGrad(texture1, texcoord, dx, dy);
+        }
+        if (weights.y > 0.0) {
+            mixed_color += weights.y * textureGrad(texture2, texcoord, dx, dy);
         }
-        ''',
-        geometry='',
-        default_input={
-            'texture_scale': Vec2(1, 1),
-            'texture1': load_texture(planet_assets["textures"]["texture_low"]),
-            'texture2': load_texture(planet_assets["textures"]["texture_mid"]),
-            'texture3': load_texture(planet_assets["textures"]["texture_top"]),
+        if (weights.z > 0.0) {
+            mixed_color += weights.z * textureGrad(texture3, texcoord, dx, dy);
         }
-    )
 
-    terrain_entity.shader = terrain_shader
+        fragColor = mix(mixed_color, far_color, far_blend) * vertex_color;
+    }
+    ''',
+    geometry='',
+    default_input={
+        'texture_scale': Vec2(1, 1),
+    }
+)
+
+# Applies the shared terrain shader with the textures of the planet and the baked maps of the current world
+def apply_terrain_shader(terrain_entity, planet_assets, terrain_maps, far_distance=120):
+    splat_texture = Texture(Image.fromarray(terrain_maps["splat_map"]))
+    splat_texture.filtering = "bilinear"
+    splat_texture.repeat = False
+    color_texture = Texture(Image.fromarray(terrain_maps["color_map"]))
+    color_texture.filtering = "bilinear"
+    color_texture.repeat = False
+
+    if terrain_entity.shader is not terrain_shader:
+        terrain_entity.shader = terrain_shader
     terrain_entity.set_shader_input("texture1", load_texture(planet_assets["textures"]["texture_low"]))
     terrain_entity.set_shader_input("texture2", load_texture(planet_assets["textures"]["texture_mid"]))
     terrain_entity.set_shader_input("texture3", load_texture(planet_assets["textures"]["texture_top"]))
+    terrain_entity.set_shader_input("splat_map", splat_texture)
+    terrain_entity.set_shader_input("color_map", color_texture)
+    terrain_entity.set_shader_input("grid_size", terrain_maps["grid_size"])
+    terrain_entity.set_shader_input("far_distance", far_distance)
 
 # Water Shaders
+# Shared vertex shader, the water rings move with the camera so the UVs come from the world position
+# They match the ones of the original water disk: 0 to 1 across the water diameter
+water_vertex_shader = '''
+#version 430
+uniform mat4 p3d_ModelViewProjectionMatrix;
+uniform mat4 p3d_ModelMatrix;
+uniform vec2 water_center;
+uniform float water_diameter;
+in vec4 p3d_Vertex;
+out vec2 uv;
+
+void main() {
+    gl_Position = p3d_ModelViewProjectionMatrix * p3d_Vertex;
+    vec3 world_position = (p3d_ModelMatrix * p3d_Vertex).xyz;
+    uv = (world_position.xz - water_center) / water_diameter + 0.5;
+}
+'''
+
 """
 SHADER EARTH
 Base Water Color: vec3(0, 0.2, 0.7)
@@ -107,9 +161,9 @@ Main Light: vec3(light1) * 0.4 (dynamic, based on noise)
 Additional Lights: vec3(1, 1, 1)
     Hex: #FFFFFF
 """
-def apply_water_shader_earth(water):
-    # Define the shader with the water effect and defined colors.
-    water_shader = Shader(fragment='''
+# Define the shader with the water effect and defined colors.
+# The shaders are created once and shared, so they are only compiled the first time they are applied
+water_shader_earth = Shader(vertex=water_vertex_shader, fragment='''
     #version 430
     vec3 permute(vec3 x) { return mod(((x*34.0)+1.0)*x, 289.0); }
     float snoise(vec2 v){
@@ -162,10 +216,16 @@ def apply_water_shader_earth(water):
         fragColor = color;
     }''')
 
-    water.shader = water_shader  
+def apply_water_shader_earth(water):
+    # The shader goes on the rings that hold the geometry, the inputs set on the parent are inherited
+    for ring in water.rings:
+        if ring.shader is not water_shader_earth:
+            ring.shader = water_shader_earth
     water.set_shader_input("iTime", 0) 
     water.set_shader_input("resolution", 90) 
     water.set_shader_input("distorsion", 0.02) 
+    water.set_shader_input("water_center", water.water_center)
+    water.set_shader_input("water_diameter", water.water_diameter)
     return water
 
 """
@@ -176,8 +236,7 @@ Main Light: vec3(light1) * 0.4 (dynamic, based on noise)
 Additional Lights: vec3(1, 0.8, 0.5)
     Hex: #FFCC80
 """
-def apply_water_shader_mars(water):
-    water_shader = Shader(fragment='''
+water_shader_mars = Shader(vertex=water_vertex_shader, fragment='''
     #version 430
 
     vec3 permute(vec3 x) { return mod(((x*34.0)+1.0)*x, 289.0); }
@@ -231,10 +290,16 @@ def apply_water_shader_mars(water):
         fragColor = color;
     }''')
 
-    water.shader = water_shader
+def apply_water_shader_mars(water):
+    # The shader goes on the rings that hold the geometry, the inputs set on the parent are inherited
+    for ring in water.rings:
+        if ring.shader is not water_shader_mars:
+            ring.shader = water_shader_mars
     water.set_shader_input("iTime", 0) 
     water.set_shader_input("resolution", 90) 
     water.set_shader_input("distorsion", 0.02) 
+    water.set_shader_input("water_center", water.water_center)
+    water.set_shader_input("water_diameter", water.water_diameter)
     return water
 
 """
@@ -245,8 +310,7 @@ Main Light: vec3(light1) * 0.4 (dynamic, based on noise)
 Additional Lights: (vec3(0.01, 0.56, 0.65))
     Hex: #028ea5 
 """
-def apply_water_shader_venus(water):
-    water_shader = Shader(fragment='''
+water_shader_venus = Shader(vertex=water_vertex_shader, fragment='''
     #version 430
 
     vec3 permute(vec3 x) { return mod(((x*34.0)+1.0)*x, 289.0); }
@@ -300,8 +364,15 @@ def apply_water_shader_venus(water):
         // Output to screen
         fragColor = color;
     }''')
-    water.shader = water_shader  
+
+def apply_water_shader_venus(water):
+    # The shader goes on the rings that hold the geometry, the inputs set on the parent are inherited
+    for ring in water.rings:
+        if ring.shader is not water_shader_venus:
+            ring.shader = water_shader_venus
     water.set_shader_input("iTime", 0) 
     water.set_shader_input("resolution", 90)
     water.set_shader_input("distorsion", 0.02) 
+    water.set_shader_input("water_center", water.water_center)
+    water.set_shader_input("water_diameter", water.water_diameter)
     return water
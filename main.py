@@ -4,15 +4,15 @@ the execution environment is configured, and the main program loop is started.
 """
 
 # Import the necessary modules and libraries
-from ursina import *  # Importing the Ursina library
 import time  # Importing necessary for using time.time() and animating shaders
-from threading import Thread  # For playing music in a separate thread
 import random  # Import random
+import gc  # Counts the Python objects alive to measure the world regeneration
 
-# Import the rest of the modules necessary to run the program
-import program_settings
-import custom_shaders
-import procedural_terrain
+# Import the engine-free modules necessary to run the program
+# Ursina, pygame and the modules that use them are imported by the functions that open the window,
+# so importing this module (as the worker processes do on some platforms) stays fast
+import terrain_core
+import terrain_raycast
 
 # Dictionaries and lists with all the references used
 # Earth model
@@ -99,110 +99,215 @@ sky_texture_list = [
     "assets/text/sky_02.png", "assets/text/sky_03.png", "assets/text/sky_04.png"
 ]
 
+# Music tracks, the ones that are missing are skipped
+music_playlist = [
+    "assets/music/documentary-background.mp3", "assets/music/folk-acoustic.mp3",
+    "assets/music/for-a-dream-lofi-vibes.mp3", "assets/music/rain-outside-your-window.mp3",
+    "assets/music/video-game-liquid-drum-and-bass.mp3"
+]
+
 # List of different menu options
 menu_list = [
     "assets/screens/menu_1.mp4", "assets/screens/menu_2.mp4",
     "assets/screens/menu_3.mp4", "assets/screens/menu_4.mp4"
 ]
 
-# Called every frame and updates the value of iTime to animate the water shader effect
-def update():
-    water.set_shader_input("iTime", time.time() - start)  # Updates the time in the water shader to animate the waves
+# Variables defining the world generation
+world_config = {
+    "size": 100,  # Dimension of the terrain map
+    "noise_scale": 10,  # Frequency of the Perlin noise used to generate the height map
+    "fade_margin": 7,  # Number of units affected to fade the edges
+    "water_level": 0,  # Height of the water on the Y axis
+    "terrain_scale": 5,  # Scaling of the world while keeping the number of polygons
+    "far_texture_distance": 120,  # Distance from which the terrain uses the baked colour map
+    "seed": None,  # Seed of the noise maps, None for a different world every time
+    "workers": 1,  # Worker processes generating the noise maps, worth raising for maps of 1024 and more
 
-# Definition of the main function
-def main():
-    global water, start
+    # Terrain elements
+    "tree_percent": 50,  # Inverse percentage, the closer to 0 the more trees
+    "max_tree_slope": 65,  # Steepest terrain, in degrees, where trees can grow (only the cliffs of this rough terrain)
+}
 
-    # Variables defining the world generation
-    size = 100  # Dimension of the terrain map
-    noise_scale = 10  # Frequency of the Perlin noise used to generate the height map
-    fade_margin = 7  # Number of units affected to fade the edges
-    water_level = 0  # Height of the water on the Y axis
-    terrain_scale = 5  # Scaling of the world while keeping the number of polygons
+# Entities of the world, kept between regenerations so they can be reused
+world = {
+    "tree_pool": None,
+    "satellite_pool": None,
+    "terrain": None,
+    "water": None,
+    "invisible_wall": None,
+    "sky": None,
+    "player": None,
+}
 
-    # Terrain elements
-    tree_percent = 50  # Inverse percentage, the closer to 0 the more trees
+# Python objects and process memory after the last regeneration, to compare one regeneration with the next
+last_regeneration = {"objects": None, "memory": None}
 
-    # Select one of the asset dictionaries randomly
-    planet_assets = procedural_terrain.select_planet(earth_assets, mars_assets, venus_assets)
+# Called every frame and updates the value of iTime to animate the water shader effect
+def update():
+    world["water"].set_shader_input("iTime", time.time() - start)  # Updates the time in the water shader to animate the waves
 
-    # Initialization of the Ursina application
-    app = Ursina()
+# Press N to generate a new planet without restarting the program
+def input(key):
+    if key == "n":
+        regenerate(world_config)
 
-    # Configure screen aspects such as resolution and whether it's windowed or full screen
-    program_settings.screen_config()
+# Builds the world described by config, reusing the entities of the previous world if there is one
+def build_world(config):
+    import custom_shaders
+    import procedural_terrain
+    import program_settings
 
-    # Create and display the splash screen
-    # The second screen starts earlier to stay in the background
-    splash_screen_2 = program_settings.SplashScreen(
-        texture=random.choice(menu_list), fade_duration=1, display_duration=18)
+    size = config["size"]
+    water_level = config["water_level"]
+    terrain_scale = config["terrain_scale"]
 
-    splash_screen_1 = program_settings.SplashScreen(
-        texture="assets/screens/splash_screen.png", fade_duration=1, display_duration=5)
-    destroy(splash_screen_1, delay=10)  
-    destroy(splash_screen_2, delay=25)  
+    # Select one of the asset dictionaries randomly
+    planet_assets = procedural_terrain.select_planet(earth_assets, mars_assets, venus_assets)
 
     # Terrain generation
     # Generate the height map
-    heightmap = procedural_terrain.generate_heightmap(size, noise_scale)
+    heightmap = terrain_core.generate_heightmap(
+        size, config["noise_scale"], seed=config["seed"], workers=config["workers"])
 
     # Make the edges fade to go under the water
-    heightmap = procedural_terrain.apply_edge_fade(heightmap, fade_margin, water_level)
+    heightmap = terrain_core.apply_edge_fade(
+        heightmap, config["fade_margin"], water_level, workers=config["workers"])
 
-    # Generate the terrain mesh
+    # Bake ambient occlusion, slope and curvature from the height map
+    lighting_maps = terrain_core.bake_lighting_maps(heightmap)
+
+    # Generate the terrain mesh, shaded with the baked ambient occlusion and darker in the valleys
+    # A previous terrain keeps its mesh and only gets new vertex buffers
     terrain_mesh = procedural_terrain.generate_terrain_mesh(
-        size, heightmap, texture_scale=(12 * terrain_scale))
+        size, heightmap, texture_scale=(12 * terrain_scale),
+        vertex_colors=terrain_core.terrain_vertex_colors(lighting_maps),
+        mesh=world["terrain"].model if world["terrain"] else None)
 
     # Create the terrain entity
-    terrain = procedural_terrain.create_terrain_entity(terrain_mesh, terrain_scale)
+    world["terrain"] = procedural_terrain.create_terrain_entity(terrain_mesh, terrain_scale, world["terrain"])
+
+    # Bake the texture blend weights and the distant colour map from the height map
+    terrain_maps = terrain_core.bake_terrain_maps(heightmap, terrain_scale, planet_assets)
 
     # Apply the shader to the terrain
-    custom_shaders.apply_terrain_shader(terrain, planet_assets)
+    custom_shaders.apply_terrain_shader(world["terrain"], planet_assets, terrain_maps, config["far_texture_distance"])
 
     # Water generation
-    # Create the flat water entity
-    water = procedural_terrain.create_water(size, water_level, terrain_scale)
+    # Create a sphere that acts as an invisible wall to prevent leaving the water plane
+    world["invisible_wall"] = program_settings.create_invisible_wall(
+        size, terrain_scale, water_level, world["invisible_wall"])
+
+    # Create the water rings that follow the camera, skipping the areas under land
+    # The rings reach the far side of the water from anywhere inside the invisible wall
+    world["water"] = procedural_terrain.create_water(
+        size, water_level, terrain_scale, heightmap, world["invisible_wall"].scale_x / 2, world["water"])
 
     # Assign the selected planet's water shader
     if "earth_shader" == planet_assets["shader"]:
-        custom_shaders.apply_water_shader_earth(water)
+        custom_shaders.apply_water_shader_earth(world["water"])
     elif "mars_shader" == planet_assets["shader"]:
-        custom_shaders.apply_water_shader_mars(water)
+        custom_shaders.apply_water_shader_mars(world["water"])
     elif "venus_shader" == planet_assets["shader"]:
-        custom_shaders.apply_water_shader_venus(water)
-
-    # Start the timer, necessary to animate the shaders
-    start = time.time()
+        custom_shaders.apply_water_shader_venus(world["water"])
 
-    # Create a sphere that acts as an invisible wall to prevent leaving the water plane
-    invisible_wall = program_settings.create_invisible_wall(size, terrain_scale, water_level)
+    # Build the min/max height pyramid used to cast rays against the terrain without its collider
+    height_pyramid = terrain_raycast.build_height_pyramid(
+        terrain_core.heightmap_world_heights(heightmap, terrain_scale), cell_size=terrain_scale)
 
     # Tree generation
     # Generate the noise map for 3D objects
-    noise_map = procedural_terrain.generate_noise_map(size, terrain_scale)
+    noise_map = terrain_core.generate_noise_map(
+        size, terrain_scale, seed=config["seed"], workers=config["workers"])
     # Assign the selected planet's trees
     tree_models = planet_assets["tree_models"]
-    # Generate trees
+    # Generate trees, reusing the ones of the previous world
+    world["tree_pool"].release_all()
     placed_trees = procedural_terrain.generate_trees(
-        water_level, water, terrain, noise_map, tree_percent, tree_models)
+        water_level, height_pyramid, noise_map, config["tree_percent"], tree_models, world["tree_pool"],
+        slope_map=lighting_maps["slope"], max_tree_slope=config["max_tree_slope"])
 
     # Add a sky entity
     # Randomly generate a sky and possibly a satellite
-    sky = procedural_terrain.custom_sky(
-        size, terrain_scale, water_level, satellites_list, sky_texture_list)
+    world["satellite_pool"].release_all()
+    world["sky"] = procedural_terrain.custom_sky(
+        size, terrain_scale, water_level, satellites_list, sky_texture_list, world["satellite_pool"], world["sky"])
 
-    # Create the first-person controller for the camera
-    player_cam = program_settings.CustomFirstPersonController()
     # Select the initial position on the terrain
-    player_cam.position = ((size * terrain_scale) / 2, size // 2, (size * terrain_scale) / 2)
+    world["player"].position = ((size * terrain_scale) / 2, size // 2, (size * terrain_scale) / 2)
+
+# Tears down the current world and builds a new one inside the running application
+# The time and the memory before and after are printed to make leaks across regenerations visible
+# Both counts are taken after a collection so only live objects are compared, and the growth since the
+# previous regeneration is printed as well, a leak shows up as a steady growth on every regeneration
+def regenerate(config):
+    from ursina import scene
+    import program_settings
+
+    gc.collect()
+    memory_before = program_settings.process_memory()
+    objects_before = len(gc.get_objects())
+    regeneration_start = time.perf_counter()
+
+    build_world(config)
+
+    regeneration_time = time.perf_counter() - regeneration_start
+    gc.collect()
+    memory_after = program_settings.process_memory()
+    objects_after = len(gc.get_objects())
+    print(f"World regenerated in {regeneration_time:.2f} s")
+    print(f"Python objects: {objects_before} -> {objects_after}, entities: {len(scene.entities)}")
+    if memory_before is not None and memory_after is not None:
+        print(f"Process memory: {memory_before / 2**20:.1f} MB -> {memory_after / 2**20:.1f} MB")
+
+    if last_regeneration["objects"] is not None:
+        print(f"Since the previous regeneration: {objects_after - last_regeneration['objects']:+d} objects")
+        if memory_after is not None and last_regeneration["memory"] is not None:
+            print(f"Since the previous regeneration: {(memory_after - last_regeneration['memory']) / 2**20:+.1f} MB")
+    last_regeneration["objects"] = objects_after
+    last_regeneration["memory"] = memory_after
+
+# Definition of the main function
+def main():
+    global start
+    from ursina import Ursina, destroy
+    import procedural_terrain
+    import program_settings
+
+    # Initialization of the Ursina application
+    app = Ursina()
+
+    # Configure screen aspects such as resolution and whether it's windowed or full screen
+    program_settings.screen_config()
+
+    # Create and display the splash screen
+    # The second screen starts earlier to stay in the background
+    splash_screen_2 = program_settings.SplashScreen(
+        texture=random.choice(menu_list), fade_duration=1, display_duration=18)
+
+    splash_screen_1 = program_settings.SplashScreen(
+        texture="assets/screens/splash_screen.png", fade_duration=1, display_duration=5)
+    destroy(splash_screen_1, delay=10)  
+    destroy(splash_screen_2, delay=25)  
+
+    # Create the first-person controller for the camera, it is placed on the terrain by build_world
+    world["player"] = program_settings.CustomFirstPersonController()
+
+    # Pools that keep the trees and satellites between regenerations
+    world["tree_pool"] = procedural_terrain.EntityPool()
+    world["satellite_pool"] = procedural_terrain.EntityPool()
+
+    # Generate the first world
+    build_world(world_config)
+
+    # Start the timer, necessary to animate the shaders
+    start = time.time()
     """
     # DEBUG Camera controller in editor mode for debugging. To use it, disable the player camera.
     debug_mode_cam = program_settings.debug_cam()
     """
 
-    # Start playing music in a separate thread to avoid blocking execution
-    music_thread = Thread(target=program_settings.play_random_music)
-    music_thread.start()
+    # Start playing music, the tracks advance on the mixer events without blocking execution
+    audio = program_settings.AudioManager(music_playlist, volume=0.15, crossfade=3)
 
     # Run the application
     app.run()
@@ -1,12 +1,12 @@
 """
 This module is responsible for the procedural generation of terrains and map elements.
-It uses multiple methods to create varied and dynamic terrains that make up the game world.
+It turns the data computed by terrain_core into the Ursina entities that make up the game world.
 """
 
 from ursina import *
 import random
-from noise import pnoise2
 import numpy as np
+import terrain_core
 
 # Selects one of the asset dictionaries randomly
 def select_planet(earth_assets, mars_assets, venus_assets):
@@ -19,180 +19,232 @@ def select_planet(earth_assets, mars_assets, venus_assets):
         return venus_assets
 
 # GROUND
-# Generates Perlin noise to be applied to the terrain map to create elevations and depressions
-def generate_heightmap(size, noise_scale):
-    base = random.randint(0, 75)
-    heightmap = np.zeros((size, size))
-    for x in range(size):
-        for z in range(size):
-            heightmap[x][z] = pnoise2(x / noise_scale, z / noise_scale, 
-                                      octaves=random.randint(1, 7),
-                                      repeatx=size, repeaty=size, base=base)
-    return heightmap
-
-# Applies a fade factor on the edges to make them fall below the water level
-def apply_edge_fade(heightmap, fade_margin, water_level):
-    size = heightmap.shape[0]
-    for x in range(size):
-        for z in range(size):
-            distance_to_edge = min(x, z, size - x - 1, size - z - 1)
-            fade_factor = min(1.0, distance_to_edge / fade_margin)
-            heightmap[x][z] *= fade_factor
-
-            if distance_to_edge < fade_margin:
-                heightmap[x][z] = min(heightmap[x][z], water_level - 0.05)
-    return heightmap
-
-# Sets the normals of the 3D model to make them all face outward
-def calculate_normals(vertices, triangles):
-    normals = [Vec3(0, 0, 0) for _ in range(len(vertices))]
-    for i in range(0, len(triangles), 3):
-        v1, v2, v3 = triangles[i], triangles[i + 1], triangles[i + 2]
-        normal = (vertices[v2] - vertices[v1]).cross(vertices[v3] - vertices[v1]).normalized()
-        normals[v1] += normal
-        normals[v2] += normal
-        normals[v3] += normal
-    return [n.normalized() for n in normals]
-
-# Generates the mesh of a plane based on the points created in generate_heightmap and the normalized triangles of calculate_normals
-def generate_terrain_mesh(size, heightmap, texture_scale):
-    vertices = []
-    triangles = []
-    uvs = []
-    for x in range(size):
-        for z in range(size):
-            y = heightmap[x][z] * 15
-            vertices.append(Vec3(x, y, z))
-            uvs.append((x / size * texture_scale, z / size * texture_scale))
-            if x < size - 1 and z < size - 1:
-                i = x * size + z
-                triangles.append(i)
-                triangles.append(i + 1)
-                triangles.append(i + size)
-                triangles.append(i + 1)
-                triangles.append(i + size + 1)
-                triangles.append(i + size)
-
-    normals = calculate_normals(vertices, triangles)
-    mesh = Mesh(vertices=vertices, triangles=triangles, normals=normals, uvs=uvs, mode='triangle')
+# Generates the mesh of the terrain from the vertex buffers of terrain_core.terrain_mesh_buffers
+# The optional vertex colors are indexed like the height map and are multiplied with the textures by the terrain shader
+# If an existing mesh is given its vertex buffers are replaced instead of creating a new one
+def generate_terrain_mesh(size, heightmap, texture_scale, vertex_colors=None, mesh=None):
+    buffers = terrain_core.terrain_mesh_buffers(size, heightmap, texture_scale)
+    vertices = [tuple(vertex) for vertex in buffers["vertices"].tolist()]
+    triangles = buffers["triangles"].tolist()
+    normals = [tuple(normal) for normal in buffers["normals"].tolist()]
+    uvs = [tuple(uv) for uv in buffers["uvs"].tolist()]
+    colors = None
+    if vertex_colors is not None:
+        colors = [tuple(vertex_color) for vertex_color in vertex_colors.reshape(-1, 4).tolist()]
+    if mesh is None:
+        return Mesh(vertices=vertices, triangles=triangles, normals=normals, uvs=uvs, colors=colors, mode='triangle')
+
+    mesh.vertices = vertices
+    mesh.triangles = triangles
+    mesh.normals = normals
+    mesh.uvs = uvs
+    mesh.colors = colors
+    mesh.generate()
     return mesh
 
 # Generates the 3D model entity that creates the terrain
-def create_terrain_entity(mesh, terrain_scale):
-    terrain_entity = Entity(model=mesh, collider='mesh', double_sided=True)
+# An existing terrain entity can be passed to reuse it, only its collider is rebuilt from the new mesh
+def create_terrain_entity(mesh, terrain_scale, terrain_entity=None):
+    if terrain_entity is None:
+        terrain_entity = Entity(model=mesh, collider='mesh', double_sided=True)
+    else:
+        if terrain_entity.model is not mesh:
+            terrain_entity.model = mesh
+        terrain_entity.collider = 'mesh'
     terrain_entity.scale = (terrain_scale, terrain_scale, terrain_scale)
-    terrain_entity.position = (0, ((terrain_scale / 2) // 2), 0)
+    terrain_entity.position = (0, terrain_core.terrain_height_offset(terrain_scale), 0)
     return terrain_entity
 
 # WATER
-# Creates the flat circular shape to create the water layer
-def create_circular_water_mesh(radius, resolution):
-    vertices = []
-    triangles = []
-    for i in range(resolution):
-        angle = 2 * np.pi * i / resolution
-        x = np.cos(angle) * radius
-        z = np.sin(angle) * radius
-        vertices.append(Vec3(x, 0, z))
-    vertices.append(Vec3(0, 0, 0))
-    for i in range(resolution):
-        triangles.append(resolution)
-        triangles.append(i)
-        triangles.append((i + 1) % resolution)
-    normals = [Vec3(0, 1, 0) for _ in range(len(vertices))]
-    uvs = [(v.x / radius / 2 + 0.5, v.z / radius / 2 + 0.5) for v in vertices]
-    mesh = Mesh(vertices=vertices, triangles=triangles, normals=normals, uvs=uvs, mode='triangle')
-    return mesh
-
-# Creates the 3D model entity that creates the water
-def create_water(size, water_level, terrain_scale):
-    radius = size / 2
-    resolution = size
-    water_mesh = create_circular_water_mesh(radius, resolution)
-    water_entity = Entity(model=water_mesh, position=((size * terrain_scale) / 2, water_level, (size * terrain_scale) / 2),
-                          scale=(terrain_scale * 1.5, 1, terrain_scale * 1.5), collider='box')
+# Camera-centred water made of concentric rings of cells (a clipmap)
+# Ring 0 is a full grid of 2 * ring_cells cells of cell_size around the camera, every next ring doubles the cell size
+# and leaves a hole where the previous one is. Each ring is snapped to twice its cell size, so it is only rebuilt
+# when the camera crosses one of those steps or when the ring inside it moves its hole,
+# and the cells under land or outside the water radius are not built
+# camera_radius is how far from the water centre the camera can go, the coarsest ring always reaches the far edge from there
+class WaterClipmap(Entity):
+    def __init__(self, center, radius, water_level, coverage, camera_radius, cell_size=2, ring_cells=16, **kwargs):
+        super().__init__(**kwargs)
+        self.cell_size = cell_size
+        self.ring_cells = ring_cells
+        self.rings = []
+        self.set_water(center, radius, water_level, coverage, camera_radius)
+
+    # Moves the water to a new world, the rings are rebuilt in place and more are added if the water got bigger
+    def set_water(self, center, radius, water_level, coverage, camera_radius):
+        self.position = (0, water_level, 0)
+        self.water_center = Vec2(center[0], center[1])
+        self.water_radius = radius
+        self.water_diameter = radius * 2
+        self.coverage = coverage
+
+        # A ring covers (ring_cells - 1) of its cells around the camera whatever its snapped centre,
+        # and has to reach the far edge of the water from the furthest point the camera can be at
+        reach = radius + camera_radius
+        self.levels = 1
+        while (self.ring_cells - 1) * self.cell_size * 2 ** (self.levels - 1) < reach:
+            self.levels += 1
+        while len(self.rings) < self.levels:
+            ring = Entity(parent=self, model=Mesh(mode='triangle', static=False))
+            if self.rings:
+                ring.shader = self.rings[0].shader
+            self.rings.append(ring)
+        for ring in self.rings[self.levels:]:
+            ring.enabled = False
+
+        # Flat collider over the whole water, like the original water plane
+        self.collider = BoxCollider(self, center=Vec3(center[0], 0, center[1]), size=Vec3(self.water_diameter, 0, self.water_diameter))
+        self.ring_centers = [None] * len(self.rings)
+        self.update()
+
+    # Vertices and triangles of one ring around its snapped centre
+    def build_ring_cells(self, level, ring_center):
+        cell = self.cell_size * 2 ** level
+        offsets = np.arange(-self.ring_cells, self.ring_cells) * cell
+        x0, z0 = np.meshgrid(ring_center[0] + offsets, ring_center[1] + offsets, indexing="ij")
+        x0, z0 = x0.ravel(), z0.ravel()
+        x1, z1 = x0 + cell, z0 + cell
+
+        keep = np.ones(x0.shape, dtype=bool)
+        if level > 0:
+            # Hole left for the finer ring, its edges always fall on this ring's cells
+            inner_x, inner_z = self.ring_centers[level - 1]
+            half_inner = self.ring_cells * cell / 2
+            epsilon = cell * 1e-3
+            keep &= ~((x0 > inner_x - half_inner - epsilon) & (x1 < inner_x + half_inner + epsilon)
+                      & (z0 > inner_z - half_inner - epsilon) & (z1 < inner_z + half_inner + epsilon))
+
+        # Closest point of every cell to the centre of the water
+        nearest_x = np.clip(self.water_center.x, x0, x1) - self.water_center.x
+        nearest_z = np.clip(self.water_center.y, z0, z1) - self.water_center.y
+        keep &= np.hypot(nearest_x, nearest_z) < self.water_radius
+        keep &= terrain_core.visible_water_cells(self.coverage, x0, z0, x1, z1)
+        x0, z0, x1, z1 = x0[keep], z0[keep], x1[keep], z1[keep]
+
+        corners_x = np.stack([x0, x1, x1, x0], axis=1).ravel()
+        corners_z = np.stack([z0, z0, z1, z1], axis=1).ravel()
+
+        # Pull the corners outside the water radius onto its edge to keep the round shape
+        distance_x = corners_x - self.water_center.x
+        distance_z = corners_z - self.water_center.y
+        distance = np.maximum(np.hypot(distance_x, distance_z), 1e-6)
+        pull = np.minimum(1.0, self.water_radius / distance)
+        corners_x = self.water_center.x + distance_x * pull
+        corners_z = self.water_center.y + distance_z * pull
+
+        vertices = np.stack([corners_x, np.zeros_like(corners_x), corners_z], axis=1)
+        first = np.arange(len(x0)) * 4
+        triangles = np.stack([first, first + 1, first + 2, first, first + 2, first + 3], axis=1).ravel()
+        return vertices, triangles
+
+    def build_ring(self, level):
+        vertices, triangles = self.build_ring_cells(level, self.ring_centers[level])
+        ring = self.rings[level]
+        ring.enabled = len(triangles) > 0
+        if ring.enabled:
+            ring.model.vertices = [tuple(vertex) for vertex in vertices.tolist()]
+            ring.model.triangles = triangles.tolist()
+            ring.model.generate()
+
+    # Rebuilds the rings whose snapped centre changed, and the ring just around each of them because its hole moved
+    def update(self):
+        inner_moved = False
+        for level in range(self.levels):
+            snap = self.cell_size * 2 ** (level + 1)
+            ring_center = (round(camera.world_x / snap) * snap, round(camera.world_z / snap) * snap)
+            moved = ring_center != self.ring_centers[level]
+            if moved:
+                self.ring_centers[level] = ring_center
+            if moved or inner_moved:
+                self.build_ring(level)
+            inner_moved = moved
+
+# Creates the water that follows the camera, covering the same circle as the original water plane
+# camera_radius is the distance from the centre the camera is kept within, the radius of the invisible wall
+# An existing water entity can be passed to move it to the new world
+def create_water(size, water_level, terrain_scale, heightmap, camera_radius, water_entity=None):
+    center = ((size * terrain_scale) / 2, (size * terrain_scale) / 2)
+    radius = (size / 2) * terrain_scale * 1.5
+    coverage = terrain_core.build_water_coverage(heightmap, terrain_scale, water_level)
+    if water_entity is None:
+        water_entity = WaterClipmap(center, radius, water_level, coverage, camera_radius)
+    else:
+        water_entity.set_water(center, radius, water_level, coverage, camera_radius)
     return water_entity
 
+# ENTITY POOLS
+# Keeps the entities of a world so the next one reuses them instead of creating new ones
+# The model is only loaded again when it changes and the collider, which Ursina builds again on every assignment,
+# only when it or the model changes. The rest of the attributes are always set
+class EntityPool:
+    def __init__(self):
+        self.entities = []
+        self.in_use = 0
+
+    def acquire(self, **attributes):
+        if self.in_use < len(self.entities):
+            entity = self.entities[self.in_use]
+            entity.enabled = True
+        else:
+            entity = Entity()
+            entity.pooled_model = None
+            entity.pooled_collider = None
+            self.entities.append(entity)
+        self.in_use += 1
+
+        model_changed = "model" in attributes and entity.pooled_model != attributes["model"]
+        for name, value in attributes.items():
+            if name == "model" and not model_changed:
+                continue
+            if name == "collider" and not model_changed and entity.pooled_collider == value:
+                continue
+            setattr(entity, name, value)
+        entity.pooled_model = attributes.get("model", entity.pooled_model)
+        entity.pooled_collider = attributes.get("collider", entity.pooled_collider)
+        return entity
+
+    # Hides every entity handed out, they stay in the pool for the next world
+    def release_all(self):
+        for entity in self.entities[:self.in_use]:
+            entity.enabled = False
+        self.in_use = 0
+
 # TREES AND OBJECTS
-# Generates a noise map that is converted to numeric values based on grayscale
-def generate_noise_map(size, terrain_scale):
-    size_map = size * terrain_scale
-    base = random.randint(0, 75)
-    noise_map = np.zeros((size_map, size_map))
-
-    for y in range(size_map):
-        for x in range(size_map):
-            noise_value = pnoise2(x / terrain_scale, y / terrain_scale, base=base)
-            noise_map[x][y] = (noise_value + 0.5) / 1.5
-
-    return noise_map
-
-# Places trees on the terrain based on their height
-# The maximum is 0.75 out of 1 to leave 25% of the map without objects
-def generate_trees(water_level, water_entity, terrain_entity, objects_map, tree_percent, tree_models):
-    lower_tree_limit = 0.375
-    upper_tree_limit = 0.75
-    size = len(objects_map)
-
-    adjust_lower_tree_limit = lower_tree_limit + ((upper_tree_limit - lower_tree_limit) * tree_percent) / 100.0
-
-    placed_positions = set()
-
-    # Checks at the opacity points above the indicated level if the terrain is above water_level
-    # If so, places the tree at the height established by the raycast
-    for y in range(size):
-        for x in range(size):
-            if adjust_lower_tree_limit <= objects_map[x][y] <= upper_tree_limit:
-                world_position = Vec3(x, 0, y) + terrain_entity.position
-                hit_info = raycast(world_position + Vec3(0, 50, 0), Vec3(0, -1, 0), ignore=[water_entity])
-
-                if hit_info.hit and hit_info.world_point.y > water_level:
-                    tree_type = None
-                    if water_level < hit_info.world_point.y <= 2:
-                        tree_type = random.choice(tree_models['low'])
-                    elif 2 < hit_info.world_point.y <= 15:
-                        tree_type = random.choice(tree_models['med'])
-                    elif hit_info.world_point.y > 15:
-                        tree_type = random.choice(tree_models['top'])
-
-                    if tree_type and (x, y) not in placed_positions:
-                        tree = Entity(
-                            model=tree_type['model'],
-                            scale=tree_type['scale'],
-                            position=hit_info.world_point,
-                            collider=tree_type['collider'],
-                            rotation=(0, random.randint(0, 360), 0)
-                        )
-                        placed_positions.add((x, y))
-                        mark_surroundings(objects_map, x, y, size)
+# Places trees on the terrain at the points found by terrain_core.place_trees, with a random model of their height tier
+# The trees are taken from tree_pool, so a new world reuses the entities of the previous one
+def generate_trees(water_level, height_pyramid, objects_map, tree_percent, tree_models, tree_pool,
+                   slope_map=None, max_tree_slope=65):
+    placements = terrain_core.place_trees(
+        water_level, height_pyramid, objects_map, tree_percent, slope_map, max_tree_slope)
+    for point, tier in placements:
+        tree_type = random.choice(tree_models[tier])
+        tree = tree_pool.acquire(
+            model=tree_type['model'],
+            scale=tree_type['scale'],
+            position=Vec3(*point),
+            collider=tree_type['collider'],
+            rotation=(0, random.randint(0, 360), 0)
+        )
 
     return objects_map
 
-# Marks the space where an object has been placed and all its adjacent spaces as 1 to prevent overlapping
-def mark_surroundings(objects_map, x, y, size):
-    offsets = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
-    for dx, dy in offsets:
-        nx, ny = x + dx, y + dy
-        if 0 <= nx < size and 0 <= ny < size:
-            objects_map[nx][ny] = 1.0
-
 # Creates a sky by applying a texture to the inside of a sphere and can also generate some satellites
-def custom_sky(size, terrain_scale, water_level, satellites_list, sky_texture_list):
-    dome_sky = Entity(
-        parent=scene,
-        model='sphere',
-        texture=random.choice(sky_texture_list),
-        position=((size * terrain_scale) / 2, water_level, (size * terrain_scale) / 2),
-        scale=((size * terrain_scale) * 1.75, (size * terrain_scale) * 1.75, (size * terrain_scale) * 1.75),
-        double_sided=True
-    )
+# The satellites are taken from satellite_pool and an existing dome can be passed to reuse it, the dome is returned
+def custom_sky(size, terrain_scale, water_level, satellites_list, sky_texture_list, satellite_pool, dome_sky=None):
+    if dome_sky is None:
+        dome_sky = Entity(parent=scene, model='sphere', double_sided=True)
+    dome_sky.texture = random.choice(sky_texture_list)
+    dome_sky.position = ((size * terrain_scale) / 2, water_level, (size * terrain_scale) / 2)
+    dome_sky.scale = ((size * terrain_scale) * 1.75, (size * terrain_scale) * 1.75, (size * terrain_scale) * 1.75)
 
     # Places a random number of satellites in the sky
     satellites_number = random.randint(0, 2)
     for i in range(satellites_number):
-        satellite = Entity(
+        satellite = satellite_pool.acquire(
             model= random.choice(satellites_list),  # The model and texture are selected from the sky_texture list
             scale= random.uniform(0.001, 0.05), 
             position=(random.randint(50, 400), random.randint(150, 200), random.randint(50, 400)),  # Random position of the satellites in X, Y, Z
              double_sided=True
         ) 
+
+    return dome_sky
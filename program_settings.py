@@ -6,8 +6,9 @@ including music and other effects. It allows customization of the user experienc
 # Imports the necessary modules and libraries
 from ursina import *
 from ursina.prefabs.first_person_controller import FirstPersonController
-import pygame
 import random
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 # HD window configuration with integer values
 def screen_config():
@@ -49,69 +50,187 @@ class SplashScreen(Entity):
         invoke(self.disable, delay=self.fade_duration)
 
 # Creates a sphere slightly smaller than the water size to prevent leaving the environment
-def create_invisible_wall(size, terrain_scale, water_level):
-    invisible_wall = Entity(
-        position=((size * terrain_scale) / 2, water_level, (size * terrain_scale) / 2),
-        scale=((size * terrain_scale) * 1.45, (size * terrain_scale) * 1.45, (size * terrain_scale) * 1.45),
-        model="sphere",
-        collider="mesh",
-        visible=False,
-        double_sided=False
-    )
+# An existing wall can be passed to fit it to a new world
+def create_invisible_wall(size, terrain_scale, water_level, invisible_wall=None):
+    if invisible_wall is None:
+        invisible_wall = Entity(
+            model="sphere",
+            collider="mesh",
+            visible=False,
+            double_sided=False
+        )
+    invisible_wall.position = ((size * terrain_scale) / 2, water_level, (size * terrain_scale) / 2)
+    invisible_wall.scale = ((size * terrain_scale) * 1.45, (size * terrain_scale) * 1.45, (size * terrain_scale) * 1.45)
     return invisible_wall
 
+# Memory used by the process in bytes, read from /proc where it is available, None elsewhere
+def process_memory():
+    try:
+        with open("/proc/self/statm") as statm:
+            resident_pages = int(statm.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE")
+
 # Create the first-person camera by redefining the base class FirstPersonController
 class CustomFirstPersonController(FirstPersonController):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        # Assign key events
-        self.volume = 1.0
-        self.is_paused = False
 
     def update(self):
         super().update()
         if held_keys["escape"]:
             application.quit() # Add functionality to close the program when pressing Escape
 
-        # Volume control and pause
-        if held_keys["1"]:
+def debug_cam():
+    EditorCamera()
+    print("Editor camera mode for debug")
+
+# Music playback
+# Keeps only the tracks that exist, relative paths are resolved from the program folder
+def validate_playlist(playlist):
+    program_folder = os.path.dirname(os.path.abspath(__file__))
+    valid_tracks = []
+    for track in playlist:
+        track_path = os.path.join(program_folder, track)
+        if os.path.isfile(track_path):
+            valid_tracks.append(track_path)
+        else:
+            print(f"Missing music track: {track}")
+    return valid_tracks
+
+# Plays the playlist in random order on two mixer channels, without any background polling
+# The tracks advance on the channel end event, the next track is decoded ahead of time in a worker thread
+# and, if crossfade is above 0, it fades in over the last crossfade seconds of the current one
+# Tracks that cannot be decoded are dropped from the playlist, and the music is disabled when none is left
+# Keys 1 and 3 lower and raise the volume and key 2 pauses, once per key press
+# pygame is only imported once there is music to play
+class AudioManager(Entity):
+    def __init__(self, playlist, volume=0.15, crossfade=3, **kwargs):
+        super().__init__(**kwargs)
+        self.playlist = validate_playlist(playlist)
+        self.volume = volume
+        self.crossfade = crossfade
+        self.is_paused = False
+        self.shuffled_tracks = []
+        self.current_channel = 0
+        self.current_sound = None
+        self.current_track = None
+        self.track_length = 0
+        self.elapsed = 0
+        self.waiting_next = False
+
+        if not self.playlist:
+            print("No music tracks found, music disabled")
+            self.enabled = False
+            return
+
+        import pygame
+        pygame.init()
+        pygame.mixer.set_reserved(2)
+        self.pygame = pygame
+        # Event posted by the mixer channels when a track ends
+        self.track_end_event = pygame.USEREVENT + 1
+        self.channels = [pygame.mixer.Channel(0), pygame.mixer.Channel(1)]
+        for channel in self.channels:
+            channel.set_endevent(self.track_end_event)
+
+        # The first track starts from update as soon as it has been decoded
+        self.loader = ThreadPoolExecutor(max_workers=1)
+        self.preload_next()
+
+    # Picks the next track, reshuffling the playlist after every full round
+    def next_track_path(self):
+        if not self.shuffled_tracks:
+            self.shuffled_tracks = random.sample(self.playlist, len(self.playlist))
+        return self.shuffled_tracks.pop()
+
+    # Decodes a track, reusing the current one when the same track repeats
+    def load_track(self, track_path):
+        if track_path == self.current_track:
+            return self.current_sound
+        return self.pygame.mixer.Sound(track_path)
+
+    def preload_next(self):
+        self.next_track = self.next_track_path()
+        self.next_sound = self.loader.submit(self.load_track, self.next_track)
+
+    # Starts the preloaded track on the free channel and fades out the current one
+    # Only called once the preloaded track is done, so it never waits for the decoding
+    def play_next(self, fade_ms=0):
+        try:
+            sound = self.next_sound.result()
+        except (self.pygame.error, OSError) as error:
+            self.drop_track(self.next_track, error)
+            return
+        self.waiting_next = False
+        if fade_ms:
+            self.channels[self.current_channel].fadeout(fade_ms)
+        self.current_channel = 1 - self.current_channel
+        sound.set_volume(self.volume)
+        self.channels[self.current_channel].play(sound, fade_ms=fade_ms)
+
+        self.current_sound = sound
+        self.current_track = self.next_track
+        self.track_length = sound.get_length()
+        self.elapsed = 0
+        self.preload_next()
+
+    # Removes a track that failed to decode and preloads another one, or disables the music if it was the last one
+    def drop_track(self, track_path, error):
+        print(f"Cannot play music track {track_path}: {error}")
+        self.playlist = [track for track in self.playlist if track != track_path]
+        self.shuffled_tracks = [track for track in self.shuffled_tracks if track != track_path]
+        if not self.playlist:
+            print("No playable music tracks left, music disabled")
+            self.loader.shutdown(wait=False)
+            self.enabled = False
+            return
+        self.preload_next()
+
+    def update(self):
+        if self.current_sound is None:
+            if self.next_sound.done():
+                self.play_next()
+            return
+
+        for event in self.pygame.event.get():
+            # The end event of the faded out channel is ignored, the current one is still playing
+            if event.type == self.track_end_event and not self.is_paused and not self.channels[self.current_channel].get_busy():
+                self.waiting_next = True
+
+        # After the end of a track the next one starts as soon as it has been decoded
+        if self.waiting_next:
+            if self.next_sound.done():
+                self.play_next()
+            return
+
+        if self.is_paused or self.crossfade <= 0:
+            return
+        self.elapsed += time.dt
+        if self.elapsed >= self.track_length - self.crossfade and self.next_sound.done():
+            self.play_next(fade_ms=int(self.crossfade * 1000))
+
+    def input(self, key):
+        if key == "1":
             self.adjust_volume(-0.1)
-        if held_keys["2"]:
+        elif key == "2":
             self.toggle_pause()
-        if held_keys["3"]:
+        elif key == "3":
             self.adjust_volume(0.1)
 
     def adjust_volume(self, amount):
         self.volume = clamp(self.volume + amount, 0, 1)
-        pygame.mixer.music.set_volume(self.volume)
+        for channel in self.channels:
+            sound = channel.get_sound()
+            if sound:
+                sound.set_volume(self.volume)
         print(f"Volume: {self.volume}")
 
     def toggle_pause(self):
         self.is_paused = not self.is_paused
         if self.is_paused:
-            pygame.mixer.music.pause()
+            self.pygame.mixer.pause()
         else:
-            pygame.mixer.music.unpause()
+            self.pygame.mixer.unpause()
         print(f"Paused: {self.is_paused}")
-
-def debug_cam():
-    EditorCamera()
-    print("Editor camera mode for debug")
-
-# Music playback
-def play_random_music():
-    pygame.mixer.init()
-    pygame.mixer.music.set_volume(0.15)
-    playlist = [
-        "Terrain_Treck/assets/music/documentary-background.mp3",
-        "Terrain_Treck/assets/music/folk-acoustic.mp3",
-        "Terrain_Treck/assets/music/for-a-dream-lofi-vibes.mp3",
-        "Terrain_Treck/assets/music/rain-outside-your-window.mp3",
-        "Terrain_Treck/assets/music/video-game-liquid-drum-and-bass.mp3"
-    ]
-    random.shuffle(playlist)
-    for track in playlist:
-        pygame.mixer.music.load(track)
-        pygame.mixer.music.play()
-        while pygame.mixer.music.get_busy():
-            pygame.time.Clock().tick(10)
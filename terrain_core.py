@@ -0,0 +1,391 @@
+"""
+This module holds the engine-free part of the world generation: height map, edge fade, mesh buffers,
+baked maps, noise maps and tree placement. It only imports NumPy when it is loaded, the noise and
+image libraries are imported by the functions that need them, so tools and worker processes start quickly
+without loading Ursina or pygame.
+"""
+
+import os
+import random
+import multiprocessing
+import tempfile
+import weakref
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+
+import terrain_raycast
+
+# PARALLEL TILES
+# Creates a map backed by a memory-mapped file that worker processes can open and fill without copying it back
+# The file lives in /dev/shm when it exists so it stays in memory, and is removed when the map is released
+def create_shared_map(shape):
+    folder = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    handle, filename = tempfile.mkstemp(suffix=".map", dir=folder)
+    os.close(handle)
+    shared_map = np.memmap(filename, dtype=np.float64, mode="w+", shape=shape)
+    weakref.finalize(shared_map, remove_shared_map_file, filename)
+    return shared_map
+
+def remove_shared_map_file(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass  # Still mapped on Windows, the temporary folder cleans it
+
+# Splits a map into tiles of tile_size x tile_size cells as (row_start, row_end, column_start, column_end)
+def map_tiles(shape, tile_size):
+    return [(row, min(row + tile_size, shape[0]), column, min(column + tile_size, shape[1]))
+            for row in range(0, shape[0], tile_size) for column in range(0, shape[1], tile_size)]
+
+# Entry point of the worker processes, opens the shared map and fills one tile
+def fill_shared_tile(filename, shape, tile_function, tile, arguments):
+    shared_map = np.memmap(filename, dtype=np.float64, mode="r+", shape=shape)
+    tile_function(shared_map, *tile, *arguments)
+    del shared_map
+
+# Runs tile_function(values, row_start, row_end, column_start, column_end, *arguments) over every tile of values
+# With more than one worker the tiles are spread over a pool of processes, values must then be a shared map
+# Every cell is computed by the same function in both modes, so the result is bit-identical
+# The workers are spawned, not forked, because the caller may be the running game with the engine and audio threads,
+# and a fork of a threaded process can deadlock. The spawned workers only import this module and NumPy
+def fill_map_tiles(values, tile_function, arguments, workers=1, tile_size=256):
+    tiles = map_tiles(values.shape, tile_size)
+    if workers <= 1 or len(tiles) == 1:
+        for tile in tiles:
+            tile_function(values, *tile, *arguments)
+        return values
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        tasks = [pool.submit(fill_shared_tile, values.filename, values.shape, tile_function, tile, arguments)
+                 for tile in tiles]
+        for task in tasks:
+            task.result()
+    return values
+
+# Creates an empty size x size map, shared with the worker processes when there is more than one
+def create_map(size, workers=1):
+    if workers > 1:
+        return create_shared_map((size, size))
+    return np.zeros((size, size))
+
+# Mixes a 64-bit seed and the cell coordinates into a pseudo-random 64-bit integer
+# It only depends on the cell, not on the order or the tile in which the cells are computed
+def cell_hash(seed, x, z):
+    with np.errstate(over="ignore"):
+        value = np.uint64(seed) * np.uint64(0x9E3779B97F4A7C15)
+        value = value ^ (x.astype(np.uint64) * np.uint64(0xBF58476D1CE4E5B9))
+        value = value ^ (z.astype(np.uint64) * np.uint64(0x94D049BB133111EB))
+        value = value ^ (value >> np.uint64(31))
+        value = value * np.uint64(0xD6E8FEB86659FD93)
+        value = value ^ (value >> np.uint64(32))
+    return value
+
+# GROUND
+# Fills one tile of the height map with Perlin noise, every cell gets its own number of octaves from 1 to 7
+def heightmap_tile(heightmap, row_start, row_end, column_start, column_end, size, noise_scale, base, seed):
+    rows, columns = np.meshgrid(np.arange(row_start, row_end), np.arange(column_start, column_end), indexing="ij")
+    from noise import pnoise2
+    octaves = (cell_hash(seed, rows, columns) % np.uint64(7) + np.uint64(1)).tolist()
+    for x in range(row_start, row_end):
+        for z in range(column_start, column_end):
+            heightmap[x, z] = pnoise2(x / noise_scale, z / noise_scale,
+                                      octaves=octaves[x - row_start][z - column_start],
+                                      repeatx=size, repeaty=size, base=base)
+
+# Generates Perlin noise to be applied to the terrain map to create elevations and depressions
+# The same seed always gives the same map, whatever the number of workers
+# The Perlin base is drawn from the seed with its own label, so the terrain and the trees of a seed use different noise
+# The octaves are hashed from a 64-bit value drawn the same way, so any seed accepted by random works (negative, big or text)
+def generate_heightmap(size, noise_scale, seed=None, workers=1):
+    if seed is None:
+        seed = random.getrandbits(32)
+    base = random.Random(f"{seed}-terrain").randint(0, 75)
+    octave_seed = random.Random(f"{seed}-octaves").getrandbits(64)
+    heightmap = create_map(size, workers)
+    return fill_map_tiles(heightmap, heightmap_tile, (size, noise_scale, base, octave_seed), workers)
+
+# Applies the edge fade to one tile of the height map
+def edge_fade_tile(heightmap, row_start, row_end, column_start, column_end, fade_margin, water_level):
+    size = heightmap.shape[0]
+    rows, columns = np.meshgrid(np.arange(row_start, row_end), np.arange(column_start, column_end), indexing="ij")
+    distance_to_edge = np.minimum(np.minimum(rows, columns), np.minimum(size - rows - 1, size - columns - 1))
+    tile = heightmap[row_start:row_end, column_start:column_end]
+    tile *= np.minimum(1.0, distance_to_edge / fade_margin)
+    near_edge = distance_to_edge < fade_margin
+    tile[near_edge] = np.minimum(tile[near_edge], water_level - 0.05)
+
+# Applies a fade factor on the edges to make them fall below the water level
+# A shared map from generate_heightmap can be faded in place by several workers
+def apply_edge_fade(heightmap, fade_margin, water_level, workers=1):
+    if not isinstance(heightmap, np.memmap):
+        workers = 1
+    return fill_map_tiles(heightmap, edge_fade_tile, (fade_margin, water_level), workers)
+
+# MESH BUFFERS
+# Height of the vertices of the terrain mesh before the entity is scaled
+def heightmap_mesh_heights(heightmap):
+    return heightmap * 15
+
+# Vertical offset of the terrain entity, shared with the bake functions to know the world height of every cell
+def terrain_height_offset(terrain_scale):
+    return (terrain_scale / 2) // 2
+
+# World height of every cell of the height map, matching the terrain mesh and entity
+def heightmap_world_heights(heightmap, terrain_scale):
+    return heightmap_mesh_heights(heightmap) * terrain_scale + terrain_height_offset(terrain_scale)
+
+# Sets the normals of the 3D model to make them all face outward
+# Every vertex gets the sum of the unit normals of its triangles, normalized
+def calculate_normals(vertices, triangles):
+    corners = vertices[triangles.reshape(-1, 3)]
+    face_normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    face_normals /= np.maximum(np.linalg.norm(face_normals, axis=1, keepdims=True), 1e-12)
+    normals = np.zeros_like(vertices)
+    for corner in range(3):
+        for axis in range(3):
+            normals[:, axis] += np.bincount(triangles[corner::3], weights=face_normals[:, axis], minlength=len(vertices))
+    return normals / np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+
+# Builds the vertex buffers of a plane based on the points created in generate_heightmap and the normalized triangles of calculate_normals
+# Vertex (x, z) is at index x * size + z and every cell is split in two triangles
+def terrain_mesh_buffers(size, heightmap, texture_scale):
+    x, z = np.meshgrid(np.arange(size), np.arange(size), indexing="ij")
+    vertices = np.stack([x, heightmap_mesh_heights(np.asarray(heightmap, dtype=np.float64)), z], axis=-1).reshape(-1, 3)
+    vertices = vertices.astype(np.float64)
+    uvs = np.stack([x / size * texture_scale, z / size * texture_scale], axis=-1).reshape(-1, 2)
+    first = (x[:-1, :-1] * size + z[:-1, :-1]).ravel()
+    triangles = np.stack([first, first + 1, first + size, first + 1, first + size + 1, first + size], axis=1).ravel()
+    return {
+        "vertices": vertices,
+        "triangles": triangles,
+        "normals": calculate_normals(vertices, triangles),
+        "uvs": uvs,
+    }
+
+# TEXTURE BAKING
+# Same curve as the GLSL smoothstep, applied to a whole array at once
+def smoothstep(edge0, edge1, x):
+    t = np.clip((x - edge0) / (edge1 - edge0), 0.0, 1.0)
+    return t * t * (3.0 - 2.0 * t)
+
+# Bakes the blend weights of the terrain shader once from the height map
+# Channel 0 blends the low and mid textures, channel 1 blends the result with the top texture
+def bake_splat_weights(heightmap, terrain_scale, low_blend=(1.0, 2.5), top_blend=(13.0, 18.0)):
+    heights = heightmap_world_heights(np.asarray(heightmap, dtype=np.float32), terrain_scale)
+    weights = np.empty(heights.shape + (2,), dtype=np.float32)
+    weights[..., 0] = smoothstep(low_blend[0], low_blend[1], heights)
+    weights[..., 1] = smoothstep(top_blend[0], top_blend[1], heights)
+    return weights
+
+# Reduces a map to resolution x resolution cells by picking the nearest cell
+def resample_map(values, resolution):
+    rows = ((np.arange(resolution) + 0.5) * values.shape[0] / resolution).astype(np.intp)
+    cols = ((np.arange(resolution) + 0.5) * values.shape[1] / resolution).astype(np.intp)
+    return values[np.ix_(rows, cols)]
+
+# Average colour of a texture, which is what the GPU converges to when it is seen from far away
+def average_texture_color(texture_path):
+    from PIL import Image
+    with Image.open(texture_path) as image:
+        pixels = np.asarray(image.convert("RGB"), dtype=np.float32)
+    return pixels.reshape(-1, 3).mean(axis=0) / 255.0
+
+# Pre-composites a low resolution colour map so that distant terrain samples a single texture
+def bake_color_map(splat_weights, planet_assets, resolution=64):
+    textures = planet_assets["textures"]
+    color_low = average_texture_color(textures["texture_low"])
+    color_mid = average_texture_color(textures["texture_mid"])
+    color_top = average_texture_color(textures["texture_top"])
+
+    weights = resample_map(splat_weights, resolution)
+    blend1 = weights[..., 0:1]
+    blend2 = weights[..., 1:2]
+    color_map = color_low * (1.0 - blend1) + color_mid * blend1
+    color_map = color_map * (1.0 - blend2) + color_top * blend2
+    return color_map.astype(np.float32)
+
+# Converts a map of values between 0 and 1 indexed as [x][z] into 8-bit RGBA pixels for a texture
+# The rows are flipped because the image is uploaded bottom to top, so that texel (x, z) lands on the vertex (x, z)
+def map_to_pixels(values):
+    pixels = np.zeros(values.shape[:2] + (4,), dtype=np.uint8)
+    channels = min(values.shape[2], 3)
+    pixels[..., :channels] = np.rint(np.clip(values[..., :channels], 0.0, 1.0) * 255)
+    pixels[..., 3] = 255
+    return np.ascontiguousarray(np.flipud(pixels.transpose(1, 0, 2)))
+
+# Bakes every map needed by the terrain shader, the result only holds NumPy arrays so it can be cached with the world data
+def bake_terrain_maps(heightmap, terrain_scale, planet_assets, color_map_resolution=64):
+    splat_weights = bake_splat_weights(heightmap, terrain_scale)
+    color_map = bake_color_map(splat_weights, planet_assets, color_map_resolution)
+    return {
+        "grid_size": heightmap.shape[0],
+        "splat_map": map_to_pixels(splat_weights),
+        "color_map": map_to_pixels(color_map),
+    }
+
+# LIGHTING BAKING
+# Computes ambient occlusion, slope and curvature for the rows [row_start, row_end) of the height map
+# padded_heights is the mesh height map padded by radius cells on every side, the results are written into maps
+# The occlusion looks for the highest horizon in every direction and darkens the cell by the sine of its elevation
+def bake_lighting_band(padded_heights, maps, row_start, row_end, radius, directions):
+    columns = padded_heights.shape[1] - 2 * radius
+    center = padded_heights[row_start + radius:row_end + radius, radius:radius + columns]
+
+    def neighbour(offset_x, offset_z):
+        return padded_heights[row_start + radius + offset_x:row_end + radius + offset_x,
+                              radius + offset_z:radius + offset_z + columns]
+
+    occlusion = np.zeros_like(center)
+    for angle in np.linspace(0, 2 * np.pi, directions, endpoint=False):
+        horizon = np.zeros_like(center)
+        visited = set()
+        for step in range(1, radius + 1):
+            offset_x = int(round(np.cos(angle) * step))
+            offset_z = int(round(np.sin(angle) * step))
+            if (offset_x, offset_z) in visited or (offset_x, offset_z) == (0, 0):
+                continue
+            visited.add((offset_x, offset_z))
+            np.maximum(horizon, (neighbour(offset_x, offset_z) - center) / np.hypot(offset_x, offset_z), out=horizon)
+        occlusion += horizon / np.sqrt(1.0 + horizon * horizon)
+    maps["ambient_occlusion"][row_start:row_end] = 1.0 - occlusion / directions
+
+    gradient_x = (neighbour(1, 0) - neighbour(-1, 0)) / 2.0
+    gradient_z = (neighbour(0, 1) - neighbour(0, -1)) / 2.0
+    maps["slope"][row_start:row_end] = np.degrees(np.arctan(np.hypot(gradient_x, gradient_z)))
+
+    # Positive on ridges and peaks, negative in valleys
+    laplacian = neighbour(1, 0) + neighbour(-1, 0) + neighbour(0, 1) + neighbour(0, -1) - 4.0 * center
+    maps["curvature"][row_start:row_end] = -laplacian
+
+# Bakes the ambient occlusion, slope (in degrees) and curvature maps from the height map
+# The rows are split into bands baked by a pool of threads, NumPy releases the GIL during the array operations
+def bake_lighting_maps(heightmap, radius=8, directions=8, workers=None):
+    heights = heightmap_mesh_heights(np.asarray(heightmap, dtype=np.float32))
+    padded_heights = np.pad(heights, radius, mode="edge")
+    maps = {
+        "ambient_occlusion": np.empty_like(heights),
+        "slope": np.empty_like(heights),
+        "curvature": np.empty_like(heights),
+    }
+
+    workers = workers or os.cpu_count() or 1
+    bands = np.array_split(np.arange(heights.shape[0]), workers)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        tasks = [pool.submit(bake_lighting_band, padded_heights, maps, band[0], band[-1] + 1, radius, directions)
+                 for band in bands if len(band)]
+        for task in tasks:
+            task.result()
+    return maps
+
+# Converts the baked ambient occlusion and curvature into grey vertex colors for generate_terrain_mesh
+# This terrain is rough, so the occlusion is measured against the median of the map: only the vertices more occluded
+# than a typical one are darkened, by up to strength, instead of darkening the whole terrain
+# The valleys (negative curvature) are darkened by up to curvature_strength, relative to the 95th percentile of the map
+def terrain_vertex_colors(lighting_maps, strength=0.5, curvature_strength=0.15):
+    occlusion = np.clip(lighting_maps["ambient_occlusion"], 0.0, 1.0)
+    relative_occlusion = np.clip(occlusion / max(float(np.median(occlusion)), 1e-6), 0.0, 1.0)
+    curvature = lighting_maps["curvature"]
+    curvature_scale = max(float(np.percentile(np.abs(curvature), 95)), 1e-6)
+    concavity = np.clip(-curvature / curvature_scale, 0.0, 1.0)
+
+    shade = (1.0 - strength * (1.0 - relative_occlusion)) * (1.0 - curvature_strength * concavity)
+    colors = np.ones(shade.shape + (4,), dtype=np.float32)
+    colors[..., :3] = shade[..., np.newaxis]
+    return colors
+
+# WATER
+# Builds the coverage mask of the water from the height map
+# It is a summed-area table of the terrain vertices above the water, so any rectangle can be checked in constant time
+def build_water_coverage(heightmap, terrain_scale, water_level):
+    land = heightmap_world_heights(np.asarray(heightmap), terrain_scale) > water_level
+    land_count = np.zeros((land.shape[0] + 1, land.shape[1] + 1), dtype=np.int32)
+    land_count[1:, 1:] = land.cumsum(axis=0).cumsum(axis=1)
+    return {"land_count": land_count, "terrain_scale": terrain_scale}
+
+# Returns which water cells [x0, x1] x [z0, z1] are visible, a cell is hidden when every terrain vertex around it is above the water
+# The terrain between vertices is interpolated, so in that case the whole cell is under land
+def visible_water_cells(coverage, x0, z0, x1, z1):
+    land_count = coverage["land_count"]
+    terrain_scale = coverage["terrain_scale"]
+    last_vertex = land_count.shape[0] - 2
+    row_start = np.floor(x0 / terrain_scale).astype(np.intp)
+    row_end = np.ceil(x1 / terrain_scale).astype(np.intp) + 1
+    column_start = np.floor(z0 / terrain_scale).astype(np.intp)
+    column_end = np.ceil(z1 / terrain_scale).astype(np.intp) + 1
+
+    # Cells that reach outside the terrain are always visible
+    inside = (row_start >= 0) & (column_start >= 0) & (row_end <= last_vertex + 1) & (column_end <= last_vertex + 1)
+    row_start, row_end = np.clip(row_start, 0, last_vertex + 1), np.clip(row_end, 0, last_vertex + 1)
+    column_start, column_end = np.clip(column_start, 0, last_vertex + 1), np.clip(column_end, 0, last_vertex + 1)
+    land = (land_count[row_end, column_end] - land_count[row_start, column_end]
+            - land_count[row_end, column_start] + land_count[row_start, column_start])
+    area = (row_end - row_start) * (column_end - column_start)
+    return ~(inside & (land == area))
+
+# TREES AND OBJECTS
+# Generates a noise map that is converted to numeric values based on grayscale
+# The same seed always gives the same map, whatever the number of workers
+def generate_noise_map(size, terrain_scale, seed=None, workers=1):
+    size_map = size * terrain_scale
+    if seed is None:
+        seed = random.getrandbits(32)
+    base = random.Random(f"{seed}-trees").randint(0, 75)
+    noise_map = create_map(size_map, workers)
+    return fill_map_tiles(noise_map, noise_map_tile, (terrain_scale, base), workers)
+
+# Fills one tile of the noise map of the objects
+def noise_map_tile(noise_map, row_start, row_end, column_start, column_end, terrain_scale, base):
+    from noise import pnoise2
+    for x in range(row_start, row_end):
+        for y in range(column_start, column_end):
+            noise_value = pnoise2(x / terrain_scale, y / terrain_scale, base=base)
+            noise_map[x, y] = (noise_value + 0.5) / 1.5
+
+# Finds where trees go on the terrain based on their height
+# The maximum is 0.75 out of 1 to leave 25% of the map without objects
+# The terrain height under every candidate is found with one batch of rays against the height pyramid of terrain_raycast
+# If a slope map from bake_lighting_maps is given, cells steeper than max_tree_slope degrees are not candidates
+# Returns the world point and the height tier ("low", "med" or "top") of every tree, in placement order
+def place_trees(water_level, height_pyramid, objects_map, tree_percent, slope_map=None, max_tree_slope=65):
+    lower_tree_limit = 0.375
+    upper_tree_limit = 0.75
+    size = len(objects_map)
+
+    adjust_lower_tree_limit = lower_tree_limit + ((upper_tree_limit - lower_tree_limit) * tree_percent) / 100.0
+
+    steep_cells = np.zeros((size, size), dtype=bool)
+    if slope_map is not None:
+        slope_cells = np.arange(size) * slope_map.shape[0] // size
+        steep_cells = slope_map[np.ix_(slope_cells, slope_cells)] > max_tree_slope
+
+    # Placing trees only marks cells as 1.0, so the candidates can only shrink and all the rays are cast at once
+    candidates = (adjust_lower_tree_limit <= objects_map) & (objects_map <= upper_tree_limit) & ~steep_cells
+    candidate_x, candidate_y = np.nonzero(candidates)
+    ray_origins = np.stack([candidate_x, np.full(len(candidate_x), height_pyramid["node_max"][-1] + 1), candidate_y], axis=1)
+    ray_directions = np.tile([0.0, -1.0, 0.0], (len(candidate_x), 1))
+    hits = terrain_raycast.cast_rays(height_pyramid, ray_origins, ray_directions)
+
+    # The candidates are visited row by row along Y, like the cells of the map
+    order = np.lexsort((candidate_x, candidate_y))
+    placements = []
+    for x, y, point in zip(candidate_x[order].tolist(), candidate_y[order].tolist(), hits["points"][order].tolist()):
+        # Checks if the terrain under the point is above water_level and the cell has not been marked by a previous tree
+        if not point[1] > water_level or not adjust_lower_tree_limit <= objects_map[x][y] <= upper_tree_limit:
+            continue
+        if point[1] <= 2:
+            tier = "low"
+        elif point[1] <= 15:
+            tier = "med"
+        else:
+            tier = "top"
+        placements.append((tuple(point), tier))
+        mark_surroundings(objects_map, x, y, size)
+    return placements
+
+# Marks the space where an object has been placed and all its adjacent spaces as 1 to prevent overlapping
+def mark_surroundings(objects_map, x, y, size):
+    offsets = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+    for dx, dy in offsets:
+        nx, ny = x + dx, y + dy
+        if 0 <= nx < size and 0 <= ny < size:
+            objects_map[nx][ny] = 1.0
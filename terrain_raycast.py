@@ -0,0 +1,198 @@
+"""
+This module casts rays against the terrain height map without using mesh colliders.
+It builds a min/max height pyramid once and traverses it for whole batches of rays at the same time,
+for tree placement, line of sight checks, mouse picking or camera collisions.
+Vertical rays are intersected with their cell directly and are cheap, about 4,000 in 2 ms on the 100 x 100 map.
+Other rays cost one pass of NumPy operations per DDA step of the longest ray, about 6 ms for a handful of rays,
+15 ms for 1,000 and 25 ms for 4,000, so they should be cast once per frame in a single batch, or spread over
+several frames when a frame has to stay within a small budget. benchmark_raycast.py measures it on the current machine.
+"""
+
+import numpy as np
+
+# Builds the min/max pyramid of a grid of world heights indexed as [x][z]
+# Vertex (i, j) is at origin + (i, j) * cell_size on the X and Z axes, like the vertices of the terrain mesh
+# Level 0 holds the lowest and highest corner of every cell and each next level merges 2x2 nodes of the previous one
+def build_height_pyramid(heights, cell_size=1.0, origin=(0.0, 0.0)):
+    heights = np.asarray(heights, dtype=np.float64)
+    corners = np.stack([heights[:-1, :-1], heights[1:, :-1], heights[:-1, 1:], heights[1:, 1:]])
+    level_min = [corners.min(axis=0)]
+    level_max = [corners.max(axis=0)]
+
+    while level_min[-1].shape[0] > 1 or level_min[-1].shape[1] > 1:
+        previous_min, previous_max = level_min[-1], level_max[-1]
+        pad = ((0, previous_min.shape[0] % 2), (0, previous_min.shape[1] % 2))
+        previous_min = np.pad(previous_min, pad, constant_values=np.inf)
+        previous_max = np.pad(previous_max, pad, constant_values=-np.inf)
+        rows, columns = previous_min.shape[0] // 2, previous_min.shape[1] // 2
+        level_min.append(previous_min.reshape(rows, 2, columns, 2).min(axis=(1, 3)))
+        level_max.append(previous_max.reshape(rows, 2, columns, 2).max(axis=(1, 3)))
+
+    # All the levels are flattened into one array so every ray can read its node at its own level
+    shapes = np.array([level.shape for level in level_min])
+    offsets = np.concatenate([[0], np.cumsum(shapes[:, 0] * shapes[:, 1])[:-1]])
+    return {
+        "heights": heights,
+        "cell_size": float(cell_size),
+        "origin": np.array(origin, dtype=np.float64),
+        "node_min": np.concatenate([level.ravel() for level in level_min]),
+        "node_max": np.concatenate([level.ravel() for level in level_max]),
+        "level_shapes": shapes,
+        "level_offsets": offsets,
+    }
+
+# Distance along the rays to the walls of the boxes [low, high] on one axis, inf for rays parallel to the axis
+def axis_distances(position, direction, low, high):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        to_low = (low - position) / direction
+        to_high = (high - position) / direction
+    parallel = direction == 0
+    inside = (position >= low) & (position <= high)
+    enter = np.where(parallel, np.where(inside, -np.inf, np.inf), np.minimum(to_low, to_high))
+    leave = np.where(parallel, np.where(inside, np.inf, -np.inf), np.maximum(to_low, to_high))
+    return enter, leave
+
+# Intersects the rays with the two triangles of their level 0 cell, split like the terrain mesh
+# Returns the closest distance in [start, end] (inf when there is none) and the normal of the triangle hit
+def intersect_cells(pyramid, origins, directions, cell_x, cell_z, start, end):
+    heights = pyramid["heights"]
+    cell_size = pyramid["cell_size"]
+    height_00 = heights[cell_x, cell_z]
+    height_10 = heights[cell_x + 1, cell_z]
+    height_01 = heights[cell_x, cell_z + 1]
+    height_11 = heights[cell_x + 1, cell_z + 1]
+
+    # Position of the rays inside the cell, from 0 to 1 on both axes
+    u_start = (origins[:, 0] - pyramid["origin"][0]) / cell_size - cell_x
+    w_start = (origins[:, 2] - pyramid["origin"][1]) / cell_size - cell_z
+    u_step = directions[:, 0] / cell_size
+    w_step = directions[:, 2] / cell_size
+
+    # First triangle: y = h00 + (h10 - h00) u + (h01 - h00) w, where u + w <= 1
+    # Second triangle: y = h11 + (h01 - h11) (1 - u) + (h10 - h11) (1 - w), where u + w >= 1
+    slopes = [(height_00, height_10 - height_00, height_01 - height_00),
+              (height_11 + (height_01 - height_11) + (height_10 - height_11), height_11 - height_01, height_11 - height_10)]
+    distances = np.full(len(origins), np.inf)
+    normals = np.zeros((len(origins), 3))
+    tolerance = 1e-9
+    for triangle, (base, slope_u, slope_w) in enumerate(slopes):
+        offset = origins[:, 1] - (base + slope_u * u_start + slope_w * w_start)
+        rate = directions[:, 1] - (slope_u * u_step + slope_w * w_step)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            distance = np.where(rate != 0, -offset / rate, np.inf)
+        u = u_start + distance * u_step
+        w = w_start + distance * w_step
+        inside = (u >= -tolerance) & (u <= 1 + tolerance) & (w >= -tolerance) & (w <= 1 + tolerance)
+        inside &= (u + w <= 1 + tolerance) if triangle == 0 else (u + w >= 1 - tolerance)
+        valid = inside & (distance >= start - tolerance) & (distance <= end + tolerance) & (distance < distances)
+        distances = np.where(valid, distance, distances)
+        normals[valid] = np.stack([-slope_u[valid] / cell_size, np.ones(valid.sum()), -slope_w[valid] / cell_size], axis=1)
+
+    normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+    return distances, normals
+
+# Casts a batch of rays against the height map with a hierarchical DDA over the min/max pyramid
+# origins and directions are (N, 3) arrays, the directions do not need to be normalized
+# Returns a dictionary with the hit mask, the hit points and normals, and the distances (inf for the rays that miss)
+def cast_rays(pyramid, origins, directions, max_distance=np.inf):
+    origins = np.atleast_2d(np.asarray(origins, dtype=np.float64))
+    directions = np.atleast_2d(np.asarray(directions, dtype=np.float64))
+    directions = directions / np.maximum(np.linalg.norm(directions, axis=1, keepdims=True), 1e-12)
+    ray_count = len(origins)
+
+    cell_size = pyramid["cell_size"]
+    grid_origin = pyramid["origin"]
+    level_shapes = pyramid["level_shapes"]
+    level_offsets = pyramid["level_offsets"]
+    top_level = len(level_shapes) - 1
+    grid_end = grid_origin + level_shapes[0] * cell_size
+
+    # Clip the rays to the box around the whole terrain
+    enter_x, leave_x = axis_distances(origins[:, 0], directions[:, 0], grid_origin[0], grid_end[0])
+    enter_z, leave_z = axis_distances(origins[:, 2], directions[:, 2], grid_origin[1], grid_end[1])
+    enter_y, leave_y = axis_distances(origins[:, 1], directions[:, 1], pyramid["node_min"][-1], pyramid["node_max"][-1])
+    start = np.maximum.reduce([enter_x, enter_z, enter_y, np.zeros(ray_count)])
+    end = np.minimum.reduce([leave_x, leave_z, leave_y, np.full(ray_count, float(max_distance))])
+
+    distances = np.full(ray_count, np.inf)
+    normals = np.zeros((ray_count, 3))
+    active = np.flatnonzero(start <= end)
+
+    # Vertical rays (ground snapping, tree placement) stay in one cell, so they are intersected directly
+    vertical = active[(directions[active, 0] == 0) & (directions[active, 2] == 0)]
+    if len(vertical):
+        cell_x = np.clip(np.floor((origins[vertical, 0] - grid_origin[0]) / cell_size).astype(np.intp), 0, level_shapes[0, 0] - 1)
+        cell_z = np.clip(np.floor((origins[vertical, 2] - grid_origin[1]) / cell_size).astype(np.intp), 0, level_shapes[0, 1] - 1)
+        hit_distances, hit_normals = intersect_cells(
+            pyramid, origins[vertical], directions[vertical], cell_x, cell_z, start[vertical], end[vertical])
+        found = np.isfinite(hit_distances)
+        distances[vertical[found]] = hit_distances[found]
+        normals[vertical[found]] = hit_normals[found]
+        active = np.setdiff1d(active, vertical, assume_unique=True)
+
+    # Everything the loop needs per ray is packed into one array, so dropping the finished rays is one indexing
+    # The distance to the next wall of a node on each axis is (wall - origin) / direction, the walls ahead are
+    # picked by the sign of the direction and the parallel axes give inf (or nan, which fmin ignores)
+    with np.errstate(divide="ignore"):
+        inverse_x = np.where(directions[:, 0] == 0, np.inf, 1.0 / directions[:, 0])
+        inverse_z = np.where(directions[:, 2] == 0, np.inf, 1.0 / directions[:, 2])
+    ray_state = np.stack([origins[:, 0], origins[:, 1], origins[:, 2], directions[:, 0], directions[:, 1],
+                          directions[:, 2], inverse_x, inverse_z, directions[:, 0] >= 0, directions[:, 2] >= 0, end])[:, active]
+    ray_t = start[active]
+    ray_level = np.full(len(active), top_level)
+    level_sizes = cell_size * 2.0 ** np.arange(top_level + 1)
+    level_rows, level_columns = level_shapes[:, 0], level_shapes[:, 1]
+    probe = cell_size * 1e-6
+
+    while len(active):
+        (origin_x, origin_y, origin_z, direction_x, direction_y, direction_z,
+         inverse_x, inverse_z, ahead_x, ahead_z, ray_end) = ray_state
+
+        # Node of every ray at its level, found slightly ahead so rays on a wall fall in the next node
+        node_size = level_sizes[ray_level]
+        probe_t = ray_t + probe
+        node_x = np.floor((origin_x + direction_x * probe_t - grid_origin[0]) / node_size).astype(np.intp)
+        node_z = np.floor((origin_z + direction_z * probe_t - grid_origin[1]) / node_size).astype(np.intp)
+        rows, columns = level_rows[ray_level], level_columns[ray_level]
+        inside = (node_x >= 0) & (node_x < rows) & (node_z >= 0) & (node_z < columns) & (ray_t < ray_end)
+        node_x = np.clip(node_x, 0, rows - 1)
+        node_z = np.clip(node_z, 0, columns - 1)
+        node = level_offsets[ray_level] + node_x * columns + node_z
+
+        # Part of the ray inside the node
+        with np.errstate(invalid="ignore"):
+            node_leave_x = (grid_origin[0] + (node_x + ahead_x) * node_size - origin_x) * inverse_x
+            node_leave_z = (grid_origin[1] + (node_z + ahead_z) * node_size - origin_z) * inverse_z
+        node_leave = np.fmin(np.fmin(node_leave_x, node_leave_z), ray_end)
+        height_start = origin_y + direction_y * ray_t
+        height_leave = origin_y + direction_y * node_leave
+
+        # The ray can only cross the terrain of the node if their height ranges overlap
+        crosses = (np.minimum(height_start, height_leave) <= pyramid["node_max"][node]) & \
+                  (np.maximum(height_start, height_leave) >= pyramid["node_min"][node])
+        finer = inside & crosses & (ray_level > 0)
+        test = inside & crosses & (ray_level == 0)
+
+        hit = np.zeros(len(active), dtype=bool)
+        if test.any():
+            tested = np.flatnonzero(test)
+            hit_distances, hit_normals = intersect_cells(
+                pyramid, origins[active[tested]], directions[active[tested]], node_x[tested], node_z[tested],
+                ray_t[tested], node_leave[tested])
+            found = np.isfinite(hit_distances)
+            distances[active[tested[found]]] = hit_distances[found]
+            normals[active[tested[found]]] = hit_normals[found]
+            hit[tested[found]] = True
+
+        # Rays that skip their node move to its exit and try the coarser level again
+        skip = inside & ~hit & ~finer
+        ray_t = np.where(skip, node_leave, ray_t)
+        ray_level = np.where(finer, ray_level - 1, np.where(skip, np.minimum(ray_level + 1, top_level), ray_level))
+
+        keep = inside & ~hit
+        if not keep.all():
+            active, ray_t, ray_level, ray_state = active[keep], ray_t[keep], ray_level[keep], ray_state[:, keep]
+
+    hits = np.isfinite(distances)
+    points = np.where(hits[:, np.newaxis], origins + directions * np.where(hits, distances, 0)[:, np.newaxis], np.nan)
+    return {"hit": hits, "points": points, "normals": normals, "distances": distances}